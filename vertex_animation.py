@@ -34,6 +34,12 @@ bl_info = {
 
 import bpy
 import bmesh
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 
 class RigidSettings(bpy.types.PropertyGroup):
@@ -44,30 +50,97 @@ class RigidSettings(bpy.types.PropertyGroup):
     )
 
 
-def get_per_frame_mesh_data(context, data, objects, ref_frame):
-    """Return a list of combined mesh data per frame"""
-    meshes = []
-    for i in frame_range(context.scene):
-
-        context.scene.frame_set(i)
-        depsgraph = context.evaluated_depsgraph_get()
-        bm = bmesh.new()
-        for ob in objects:
-            eval_object = ob.evaluated_get(depsgraph)
-            me = data.meshes.new_from_object(eval_object)
+def get_mesh_vertex_data(me):
+    """Return vertex coordinates and normals of mesh data as (N, 3) arrays"""
+    vertex_count = len(me.vertices)
+    co = np.empty(vertex_count * 3, dtype=np.float32)
+    me.vertices.foreach_get("co", co)
+    nrm = np.empty(vertex_count * 3, dtype=np.float32)
+    me.vertices.foreach_get("normal", nrm)
+    return co.reshape(vertex_count, 3), nrm.reshape(vertex_count, 3)
+
+
+def get_combined_mesh(data, objects, depsgraph):
+    """Return a new world space mesh combining all evaluated objects"""
+    if len(objects) == 1:
+        ob = objects[0]
+        me = data.meshes.new_from_object(ob.evaluated_get(depsgraph))
+        me.transform(ob.matrix_world)
+        return me
+    bm = bmesh.new()
+    for ob in objects:
+        eval_object = ob.evaluated_get(depsgraph)
+        me = data.meshes.new_from_object(eval_object)
+        me.transform(ob.matrix_world)
+        bm.from_mesh(me)
+        data.meshes.remove(me)
+    me = data.meshes.new("mesh")
+    bm.to_mesh(me)
+    bm.free()
+    return me
+
+
+def is_similarity(columns):
+    """Return whether a 3x3 basis only rotates, mirrors and uniformly scales"""
+    gram = columns @ columns.T
+    scale = np.trace(gram) / 3.0
+    return np.allclose(gram, np.eye(3) * scale, rtol=0.0, atol=1e-5 * scale)
+
+
+def get_combined_vertex_data(data, objects, depsgraph):
+    """Return world space vertex coordinates and normals of all evaluated objects"""
+    new_from_object = data.meshes.new_from_object
+    meshes_remove = data.meshes.remove
+    co_parts = []
+    nrm_parts = []
+    for ob in objects:
+        me = new_from_object(ob.evaluated_get(depsgraph))
+        matrix = np.array(ob.matrix_world, dtype=np.float32)
+        columns = matrix[:3, :3].T
+        if not is_similarity(columns):
+            # Non-uniform scale changes the angle weights of vertex normals,
+            # so let Blender recompute them from the transformed faces
             me.transform(ob.matrix_world)
-            bm.from_mesh(me)
-            data.meshes.remove(me)
-        me = data.meshes.new("mesh")
-        bm.to_mesh(me)
-        bm.free()
-        me.calc_normals()
-        meshes.append(me)
+            co, nrm = get_mesh_vertex_data(me)
+            meshes_remove(me)
+            co_parts.append(co)
+            nrm_parts.append(nrm)
+            continue
+        co, nrm = get_mesh_vertex_data(me)
+        meshes_remove(me)
+        co_parts.append(co @ columns + matrix[:3, 3])
+        # Under a similarity the cofactor matrix maps vertex normals exactly,
+        # mirroring included
+        cofactor = np.cross(columns[[1, 2, 0]], columns[[2, 0, 1]])
+        nrm = nrm @ cofactor
+        length = np.linalg.norm(nrm, axis=1, keepdims=True)
+        length[length == 0.0] = 1.0
+        nrm /= length
+        nrm_parts.append(nrm)
+    if len(objects) == 1:
+        return co_parts[0], nrm_parts[0]
+    return np.concatenate(co_parts), np.concatenate(nrm_parts)
+
+
+def iter_frame_vertex_data(context, data, objects, ref_frame):
+    """Yield frame index, combined vertex coordinates, normals and the reference mesh or None"""
+    scene = context.scene
+    frange = frame_range(scene)
+    if ref_frame != frange[-1]:
+        # The trailing frame is not baked and only needed as a reference
+        frange = frange[:-1]
+    for frame_idx, i in enumerate(frange):
+
+        # Evaluate in order since simulations such as cloth only advance on consecutive frames
+        scene.frame_set(i)
+        depsgraph = context.evaluated_depsgraph_get()
         if i == ref_frame:
-            export_mesh = me.copy()
-
-    meshes.remove(meshes[len(meshes)-1])
-    return meshes, export_mesh
+            refmesh = get_combined_mesh(data, objects, depsgraph)
+            co, nrm = get_mesh_vertex_data(refmesh)
+        else:
+            refmesh = None
+            co, nrm = get_combined_vertex_data(data, objects, depsgraph)
+        yield frame_idx, co, nrm, refmesh
 
 
 def create_export_mesh_object(context, data, me):
@@ -77,30 +150,80 @@ def create_export_mesh_object(context, data, me):
     uv_layer = me.uv_layers[1]
     uv_layer.name = "vertex_anim"
 
-    for loop in me.loops:
-        uv_layer.data[loop.index].uv = (
-            (loop.vertex_index + 0.5)/len(me.vertices), 128/255
-        )
+    loop_count = len(me.loops)
+    vertex_count = len(me.vertices)
+    vertex_index = np.empty(loop_count, dtype=np.int32)
+    me.loops.foreach_get("vertex_index", vertex_index)
+    uv = np.empty((loop_count, 2), dtype=np.float32)
+    uv[:, 0] = (vertex_index + 0.5) / vertex_count
+    uv[:, 1] = 128 / 255
+    uv_layer.data.foreach_set("uv", uv.reshape(-1))
     ob = data.objects.new("export_mesh", me)
     context.scene.collection.objects.link(ob)
     return ob
 
 
-def get_vertex_data(data, meshes, refmesh):
-    """Return lists of vertex offsets and normals from a list of mesh data"""
-    offsets = []
-    normals = []
-    for me in reversed(meshes):
-        for v in me.vertices:
-            # Use the default scene scale instead since the send2UE plugin will fix that.
-            offset = (v.co - refmesh.vertices[v.index].co)*100.0
-            x, y, z = offset
-            offsets.extend((x, -y, z, 1))
-            x, y, z = v.normal
-            normals.extend(((x + 1) * 0.5, (-y + 1) * 0.5, (z + 1) * 0.5, 1))
-        if not me.users:
-            data.meshes.remove(me)
-    return offsets, normals
+# Use the default scene scale instead since the send2UE plugin will fix that.
+OFFSET_SCALE = np.array((100.0, -100.0, 100.0), dtype=np.float32)
+NORMAL_SCALE = np.array((0.5, -0.5, 0.5), dtype=np.float32)
+
+
+if numba is not None:
+    @numba.njit(fastmath=True, cache=True)
+    def pack_normal_row(nrm, normal_row, scale):
+        """Write (x, -y, z) encoded normals into the rgb of a pixel row"""
+        for i in range(nrm.shape[0]):
+            for k in range(3):
+                normal_row[i, k] = nrm[i, k] * scale[k] + 0.5
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def pack_offset_rows(offsets, ref_co, scale):
+        """Turn world positions in the rgb of pixel rows into (x, -y, z) encoded offsets"""
+        for f in numba.prange(offsets.shape[0]):
+            for i in range(offsets.shape[1]):
+                for k in range(3):
+                    offsets[f, i, k] = (offsets[f, i, k] - ref_co[i, k]) * scale[k]
+else:
+    def pack_normal_row(nrm, normal_row, scale):
+        """Write (x, -y, z) encoded normals into the rgb of a pixel row"""
+        np.multiply(nrm, scale, out=normal_row[:, :3])
+        normal_row[:, :3] += 0.5
+
+    def pack_offset_rows(offsets, ref_co, scale):
+        """Turn world positions in the rgb of pixel rows into (x, -y, z) encoded offsets"""
+        offsets[:, :, :3] -= ref_co
+        offsets[:, :, :3] *= scale
+
+
+class VertexCountError(Exception):
+    """Raised when a frame's evaluated vertex count does not match the pixel buffers"""
+
+
+def fill_pixel_buffers(data, frames, offsets, normals):
+    """Fill offset and normal pixel buffers from per frame vertex data, return the reference mesh"""
+    offsets[:, :, 3] = 1.0
+    normals[:, :, 3] = 1.0
+    frame_count = len(offsets)
+    refmesh = None
+    for frame_idx, co, nrm, me in frames:
+        if me is not None:
+            refmesh, ref_co = me, co
+        if len(co) != offsets.shape[1]:
+            if refmesh is not None:
+                data.meshes.remove(refmesh)
+            raise VertexCountError(
+                f"Evaluated vertex count of {len(co) :,} does not match "
+                f"mesh vertex count of {offsets.shape[1] :,}!"
+            )
+        if frame_idx == frame_count:
+            continue
+        # Rows are stored last frame first
+        row_idx = frame_count - 1 - frame_idx
+        offsets[row_idx, :, :3] = co
+        pack_normal_row(nrm, normals[row_idx], NORMAL_SCALE)
+    # Offsets need the reference frame, which may come after the frames using it
+    pack_offset_rows(offsets, ref_co, OFFSET_SCALE)
+    return refmesh
 
 
 def frame_range(scene):
@@ -118,14 +241,14 @@ def bake_vertex_data(context, data, offsets, normals, size):
         alpha=True,
         float_buffer=True
     )
-    offset_texture.pixels = offsets
+    offset_texture.pixels.foreach_set(offsets.reshape(-1))
     normal_texture = data.images.new(
         name="normals",
         width=width,
         height=height,
         alpha=True
     )
-    normal_texture.pixels = normals
+    normal_texture.pixels.foreach_set(normals.reshape(-1))
 
 
 class OBJECT_OT_ProcessAnimMeshes(bpy.types.Operator):
@@ -136,14 +259,14 @@ class OBJECT_OT_ProcessAnimMeshes(bpy.types.Operator):
 
     @property
     def allowed_modifiers(self):
-        return [
+        return {
             'ARMATURE', 'CAST', 'CURVE', 'DISPLACE', 'HOOK',
             'LAPLACIANDEFORM', 'LATTICE', 'MESH_DEFORM',
             'SHRINKWRAP', 'SIMPLE_DEFORM', 'SMOOTH',
             'CORRECTIVE_SMOOTH', 'LAPLACIANSMOOTH',
             'SURFACE_DEFORM', 'WARP', 'WAVE',
             'CLOTH', 'COLLISION'
-        ]
+        }
 
     @classmethod
     def poll(cls, context):
@@ -160,9 +283,10 @@ class OBJECT_OT_ProcessAnimMeshes(bpy.types.Operator):
         frame_count = len(frange)-1
         if ref_frame not in frange:
             ref_frame = frange.start
+        allowed_modifiers = self.allowed_modifiers
         for ob in objects:
             for mod in ob.modifiers:
-                if mod.type not in self.allowed_modifiers:
+                if mod.type not in allowed_modifiers:
                     self.report(
                         {'ERROR'},
                         f"Objects with {mod.type.title()} modifiers are not allowed!"
@@ -176,6 +300,9 @@ class OBJECT_OT_ProcessAnimMeshes(bpy.types.Operator):
         #      "Scene Unit must be Metric with a Unit Scale of 0.01!"
         #   )
         #return {'CANCELLED'}
+        if vertex_count == 0:
+            self.report({'ERROR'}, "Selected mesh objects have no vertices!")
+            return {'CANCELLED'}
         if vertex_count > 8192:
             self.report(
                 {'ERROR'},
@@ -189,9 +316,15 @@ class OBJECT_OT_ProcessAnimMeshes(bpy.types.Operator):
             )
             return {'CANCELLED'}
 
-        meshes, export_mesh_data = get_per_frame_mesh_data(context, data, objects, ref_frame)
+        frames = iter_frame_vertex_data(context, data, objects, ref_frame)
+        offsets = np.empty((frame_count, vertex_count, 4), dtype=np.float32)
+        normals = np.empty((frame_count, vertex_count, 4), dtype=np.float32)
+        try:
+            export_mesh_data = fill_pixel_buffers(data, frames, offsets, normals)
+        except VertexCountError as error:
+            self.report({'ERROR'}, str(error))
+            return {'CANCELLED'}
         create_export_mesh_object(context, data, export_mesh_data)
-        offsets, normals = get_vertex_data(data, meshes, export_mesh_data)
         texture_size = vertex_count, frame_count
         bake_vertex_data(context, data, offsets, normals, texture_size)
         return {'FINISHED'}